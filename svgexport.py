@@ -1,33 +1,74 @@
 import os
 import math
+import bisect
+import functools
+import itertools
+import re
 import argparse
 import subprocess
-import xml.etree.ElementTree as ET
-from xml.etree.ElementTree import Element
+from array import array
+from typing import Callable
+from lxml import etree as ET
+from lxml.etree import _Element as Element
 
 # Namespace dictionary for SVG
 ns = {'svg': 'http://www.w3.org/2000/svg',
       'inkscape': 'http://www.inkscape.org/namespaces/inkscape'}
+# Namespace prefix of svg tags in Clark notation.
+SVG_NS = f'{{{ns["svg"]}}}'
+# Full tags that are compared against, so elements can be classified without stripping the namespace.
+SVG_G = SVG_NS + 'g'
+SVG_RECT = SVG_NS + 'rect'
+SVG_DEFS = SVG_NS + 'defs'
+# Attribute holding the name Inkscape shows for a layer or group.
+INK_LABEL = f'{{{ns["inkscape"]}}}label'
+
+# Parser for the template, dropping whitespace-only text nodes keeps the trees small. Comments and processing
+# instructions are dropped like the stdlib parser did, so every element has a string tag. The input document is
+# scanned with the same options in load_layers.
+_PARSER = ET.XMLParser(huge_tree=True, remove_blank_text=True, remove_comments=True, remove_pis=True)
+
+# Tags that are of interest when scanning the input document.
+_LAYER_TAGS = (SVG_G, SVG_DEFS)
+
+# One operation in a transformation list, e.g. 'translate(50,0)', optionally separated from the next by a comma.
+_TRANSFORM = re.compile(r'\s*([A-Za-z]+)\s*\(([^()]*)\)\s*,?')
+
+# Number in an svg attribute, e.g. '-1.5', '.5' or '1e-3'.
+_NUMS = re.compile(r'[-+]?\d*\.?\d+(?:[eE][-+]?\d+)?')
+# The operands of a transformation, nothing but numbers separated by commas and/or whitespace.
+_OPERANDS = re.compile(rf'\s*(?:{_NUMS.pattern}(?:\s*,?\s*{_NUMS.pattern})*)?\s*')
+
+# Operation codes of the supported transformations.
+OP_NONE, OP_TRANSLATE, OP_MATRIX, OP_ROTATE, OP_SCALE = range(5)
+
+
+def _xy_cxcy(e: Element):
+    return e.get('cx'), e.get('cy')
+
+
+def _xy_path(e: Element):
+    d = e.get('d')
+    if d:
+        # The start point are the first two numbers after the initial moveto, the rest of the path is not needed.
+        start = [m.group() for m in itertools.islice(_NUMS.finditer(d), 2)]
+        if len(start) == 2:
+            return start
+    return None, None
+
+
+def _xy_xy(e: Element):
+    return e.get('x'), e.get('y')
+
+
+# Readers of the position attributes by full tag, everything else ('rect', 'text', ...) uses x and y.
+_COORD_HANDLERS = {SVG_NS + 'circle': _xy_cxcy,
+                   SVG_NS + 'ellipse': _xy_cxcy,
+                   SVG_NS + 'path': _xy_path}
 
 
 def get_coordinates(e: Element):
-    # Get rid of the namespace from the tag.
-    tag = e.tag.replace(f'{{{ns["svg"]}}}', '')
-
-    x, y = None, None
-    match tag:
-        case 'circle' | 'ellipse':
-            x = e.attrib.get('cx')
-            y = e.attrib.get('cy')
-        case 'path':
-            d = e.attrib.get('d')
-            if d:
-                a = d.split(" ")
-                x, y = map(float, a[1].split(','))
-        case _:
-            # 'rect' and 'text' end up here.
-            x = e.attrib.get('x')
-            y = e.attrib.get('y')
+    x, y = _COORD_HANDLERS.get(e.tag, _xy_xy)(e)
 
     if x is None or y is None:
         return None
@@ -38,204 +79,327 @@ def get_coordinates(e: Element):
     # The element can have transformations applied to it.
     transformation = e.attrib.get('transform')
     if transformation is not None:
-        x, y = transform_coordinates(x, y, transformation)
+        x, y = specialize((transformation,))(x, y)
 
     return x, y
 
 
-def transform_coordinates(x: float, y: float, transformation: str) -> tuple[float, float]:
-    """Transform a pair of coordinates based on a transformation string from an svg file.
+@functools.lru_cache(maxsize=4096)
+def parse_transform(transformation: str) -> tuple[tuple[int, tuple[float, ...]], ...]:
+    """Parse a transformation string into operation codes and their numeric operands, in the order they are written.
+
+    Drawings duplicated in Inkscape share the exact same transformation strings, so the result is cached.
 
-    :param transformation: Transformation string in the form of: 'translate(50,0)'
+    :param transformation: Transformation string in the form of: 'translate(50,0)' or 'translate(50,0) rotate(45)'
+    """
+    operations = []
+    pos = 0
+    while pos < len(transformation):
+        # Split off the next operation and its numbers, which may be separated by commas and/or whitespace.
+        m = _TRANSFORM.match(transformation, pos)
+        if m is None:
+            if transformation[pos:].strip():
+                raise ValueError(f"Malformed transformation: '{transformation}'")
+            break
+        pos = m.end()
+        operation, operand = m.groups()
+        if not _OPERANDS.fullmatch(operand):
+            raise ValueError(f"Malformed operands for '{operation}' in: '{transformation}'")
+        operand = [float(n) for n in _NUMS.findall(operand)]
+
+        match operation, len(operand):
+            case 'translate', 1 | 2:
+                # The y argument is optional and assumed zero when not given: translate(<x> [<y>])
+                xt, yt = (*operand, 0.0)[:2]
+                operations.append((OP_TRANSLATE, (xt, yt)))
+            case 'matrix', 6:
+                operations.append((OP_MATRIX, tuple(operand)))
+            case 'rotate', 1 | 2 | 3:
+                # Rotation of a degrees around x,y with x and y optional: rotate(<a> [<x> <y>])
+                at, xt, yt = (*operand, 0.0, 0.0)[:3]
+                operations.append((OP_ROTATE, (at, xt, yt)))
+            case 'scale', 1 | 2:
+                # Scale operation where x=y when y is not given: scale(<x> [<y>])
+                xt, yt = (*operand, operand[0])[:2]
+                operations.append((OP_SCALE, (xt, yt)))
+            case 'translate' | 'matrix' | 'rotate' | 'scale', _:
+                raise ValueError(f"Unsupported number of operands for '{operation}' in: '{transformation}'")
+            case _:
+                # Unsupported operations leave the coordinates as they are.
+                operations.append((OP_NONE, ()))
+
+    return tuple(operations)
+
+
+def _matrix(op: int, params: tuple[float, ...]) -> tuple[float, ...]:
+    """Get the affine matrix (a, b, c, d, e, f) of a single operation parsed by parse_transform."""
+    if op == OP_TRANSLATE:
+        xt, yt = params
+        return 1.0, 0.0, 0.0, 1.0, xt, yt
+    if op == OP_MATRIX:
+        return params
+    if op == OP_ROTATE:
+        at, xt, yt = params
+        at_rad = math.radians(at)
+        cos, sin = math.cos(at_rad), math.sin(at_rad)
+        # Rotation around the origin wrapped in a translation to and from the rotation point.
+        return cos, sin, -sin, cos, xt - (cos * xt) + (sin * yt), yt - (sin * xt) - (cos * yt)
+    if op == OP_SCALE:
+        xt, yt = params
+        # Currently we just use the sign of the numbers
+        return math.copysign(1.0, xt), 0.0, 0.0, math.copysign(1.0, yt), 0.0, 0.0
+
+    return 1.0, 0.0, 0.0, 1.0, 0.0, 0.0
+
+
+def _multiply(outer: tuple[float, ...], inner: tuple[float, ...]) -> tuple[float, ...]:
+    """Multiply two affine matrices, the result applies inner first and outer second."""
+    na, nb, nc, nd, ne, nf = outer
+    a, b, c, d, e, f = inner
+    return (na * a) + (nc * b), (nb * a) + (nd * b), \
+        (na * c) + (nc * d), (nb * c) + (nd * d), \
+        (na * e) + (nc * f) + ne, (nb * e) + (nd * f) + nf
+
+
+@functools.lru_cache(maxsize=4096)
+def transform_matrix(transformation: str) -> tuple[float, ...]:
+    """Get the affine matrix (a, b, c, d, e, f) of a transformation string, as used by the svg 'matrix' operation."""
+    matrix = 1.0, 0.0, 0.0, 1.0, 0.0, 0.0
+    # In a list of transformations the rightmost one is applied to the coordinates first.
+    for op, params in reversed(parse_transform(transformation)):
+        matrix = _multiply(_matrix(op, params), matrix)
+    return matrix
+
+
+def compose(transforms: tuple[str, ...]) -> tuple[float, ...]:
+    """Fold a sequence of transformation strings into a single affine matrix (a, b, c, d, e, f).
+
+    :param transforms: Transformation strings in the order in which they are applied to the coordinates.
     """
-    # Split the string into an operation and operand.
-    operation, operand = transformation.split('(')
-    operand = operand.rstrip(')')
-
-    xtrans, ytrans = x, y
-    match operation:
-        case 'translate':
-            # The y argument is optional and assumed zero when not given: translate(<x> [<y>])
-            xt, yt = 0, 0
-
-            operand = operand.split(',')
-            if len(operand) == 2:
-                xt, yt = operand
-            else:
-                xt = operand[0]
-
-            xt = float(xt)
-            yt = float(yt)
-
-            # Translate coordinates.
-            xtrans = xtrans + xt
-            ytrans = ytrans + yt
-        case 'matrix':
-            ma, mb, mc, md, me, mf = map(float, operand.split(','))
-
-            if x is not None and y is not None:
-                xtrans = (ma * x) + (mc * y) + me
-                ytrans = (mb * x) + (md * y) + mf
-        case 'rotate':
-            # Rotation of a degrees around x,y with x and y optional: rotate(<a> [<x> <y>])
-            at, xt, yt = 0, 0, 0
-
-            operand = operand.split(',')
-            if len(operand) == 3:
-                at, xt, yt = operand
-            if len(operand) == 2:
-                at, xt = operand
-            else:
-                at = operand[0]
-
-            xt = float(xt)
-            yt = float(yt)
-            at = float(at)
-
-            # Now apply the rotation to the coordinates.
-            at_rad = math.radians(at)
-
-            x_shift = x - xt
-            y_shift = y - yt
-
-            xtrans = (x_shift * math.cos(at_rad)) - \
-                (y_shift * math.sin(at_rad))
-            ytrans = (x_shift * math.sin(at_rad)) + \
-                (y_shift * math.cos(at_rad))
-
-            xtrans += xt
-            ytrans += yt
-        case 'scale':
-            # Scale operation where x=y when y is not given: scale(<x> [<y>])
-            xt, yt = 0, 0
-
-            operand = operand.split(',')
-            if len(operand) == 2:
-                xt, yt = operand
-            else:
-                xt = operand[0]
-                yt = operand[0]
-
-            xt = float(xt)
-            yt = float(yt)
-
-            # Currently we just use the sign of the numbers
-            if xt < 0:
-                xtrans = -xtrans
-            if yt < 0:
-                ytrans = -ytrans
-
-    return xtrans, ytrans
+    matrix = 1.0, 0.0, 0.0, 1.0, 0.0, 0.0
+    for transformation in transforms:
+        matrix = _multiply(transform_matrix(transformation), matrix)
+    return matrix
+
+
+@functools.lru_cache(maxsize=4096)
+def specialize(transforms: tuple[str, ...]) -> Callable[[float, float], tuple[float, float]]:
+    """Build a function applying a sequence of transformation strings to a pair of coordinates.
+
+    The composed matrix is baked into the function, so parsing and trigonometry are done once per distinct sequence.
+    Plain translations, the most common transformation in Inkscape drawings, skip the multiplications altogether.
+
+    :param transforms: Transformation strings in the order in which they are applied to the coordinates.
+    """
+    a, b, c, d, e, f = compose(transforms)
+    if (a, b, c, d) == (1.0, 0.0, 0.0, 1.0):
+        return lambda x, y: (x + e, y + f)
+    return lambda x, y: ((a * x) + (c * y) + e, (b * x) + (d * y) + f)
 
 
 def get_first_ungrouped_element(e: Element) -> tuple[Element, list[str]]:
-    """Get the first non-group element from a set of nested groups and get all the transformations that apply to it."""
+    """Get the first non-group element from a set of nested groups and get all the transformations that apply to it.
+
+    The transformations are ordered from the innermost group outwards, which is the order to apply them in. An empty
+    group is returned as is.
+    """
     gtransforms = []
 
-    # Get the next element in the group.
-    element_iter = iter(e)
-    next_element = next(element_iter)
+    # Walk down the first child of each group until it is not a group anymore.
+    group = e
+    while True:
+        t = group.attrib.get('transform')
+        if t is not None:
+            gtransforms.append(t)
+
+        # Get the next element in the group.
+        next_element = next(iter(group), None)
+        if next_element is None:
+            next_element = group
+            break
+
+        # Is it again a group then dig deeper.
+        if next_element.tag != SVG_G:
+            break
+        group = next_element
+
+    # The transformations were collected from the outside in.
+    gtransforms.reverse()
+
+    return next_element, gtransforms
+
+
+def load_layers(xml_file, labels: tuple[str, ...]) -> tuple[dict[str, Element], list[Element]]:
+    """Get the layers with the given labels and the top-level definitions from an svg file.
+
+    The file is scanned incrementally for groups and definitions only, top-level groups that are not needed are
+    cleared as soon as they are parsed so their content does not stay in memory. When several groups have the same
+    label, the first one in document order is returned.
+    """
+    layers = {}
+    defs = []
+    context = ET.iterparse(xml_file, events=('end',), tag=_LAYER_TAGS, huge_tree=True, remove_blank_text=True,
+                           remove_comments=True, remove_pis=True)
+    for _, el in context:
+        parent = el.getparent()
+        top_level = parent is not None and parent.getparent() is None
+
+        if el.tag == SVG_DEFS:
+            if top_level:
+                defs.append(el)
+            continue
+
+        label = el.get(INK_LABEL)
+        if label in labels:
+            # Groups end after the groups nested in them, so a later match enclosing the stored one comes first in
+            # document order and replaces it. A later match elsewhere in the document does not.
+            stored = layers.get(label)
+            if stored is None or any(a is el for a in stored.iterancestors()):
+                layers[label] = el
+        elif top_level and not any(a is el for layer in layers.values() for a in layer.iterancestors()):
+            el.clear()
+
+    return layers, defs
 
-    tag = next_element.tag.replace(f'{{{ns["svg"]}}}', '')
-    # Is it again a group then dig deeper.
-    if tag == 'g':
-        non_group_element, transforms = get_first_ungrouped_element(
-            next_element)
-        gtransforms.extend(transforms)
-    else:
-        non_group_element = next_element
 
-    t = e.attrib.get('transform')
-    if t is not None:
-        gtransforms.append(t)
+def write_svg(filename: str, template_root: Element, attrib: dict[str, str], elements: list[Element]):
+    """Write an svg with the root of the template, given root attributes, and the elements appended to its children.
 
-    return non_group_element, gtransforms
+    The file is streamed out element by element, so neither the template nor the elements are copied or moved.
+    """
+    with ET.xmlfile(filename, encoding='utf-8') as xf:
+        xf.write_declaration()
+        with xf.element(template_root.tag, attrib, nsmap=template_root.nsmap):
+            if template_root.text:
+                xf.write(template_root.text)
+            for child in template_root:
+                xf.write(child)
+            for e in elements:
+                xf.write(e)
 
 
 def parse_and_export(xml_file) -> list[str]:
-    # Load in the document to parse it.
-    tree = ET.parse(xml_file)
-    root = tree.getroot()
+    # Load in the document, only keeping the layers and definitions that are needed.
+    layers, defs = load_layers(xml_file, ('Export', 'Drawings'))
 
     # Find the 'Export' layer
-    export_layer = root.find(".//svg:g[@inkscape:label='Export']", ns)
-    drawing_layer = root.find(".//svg:g[@inkscape:label='Drawings']", ns)
+    export_layer = layers.get('Export')
+    drawing_layer = layers.get('Drawings')
     if export_layer is None:
         raise RuntimeError("No 'Export' layer found.")
+    if drawing_layer is None:
+        raise RuntimeError("No 'Drawings' layer found.")
+
+    # Load the template svg to which the export images are added.
+    template_tree = ET.parse("template.svg", _PARSER)
+    template_root = template_tree.getroot()
+
+    # The position of a drawing does not depend on the export rectangle, so resolve them all once up front.
+    # The positions are kept as separate float arrays next to the list of elements, which is far more compact than a
+    # tuple per drawing.
+    xs = array('d')
+    ys = array('d')
+    elements = []
+    for e in drawing_layer:
+        sube = e
+        # Does a group transformation apply?
+        gtransform = None
+        # If we have a group get the first element in the group and all the transformations that apply.
+        if e.tag == SVG_G:
+            sube, gtransform = get_first_ungrouped_element(e)
+
+        xy = get_coordinates(sube)
+        if xy is None:
+            continue
+        else:
+            x, y = xy
+
+        if gtransform:
+            # All the group transformations folded into one function, shared by groups with the same transformations.
+            x, y = specialize(tuple(gtransform))(x, y)
+
+        if x and y:
+            xs.append(x)
+            ys.append(y)
+            elements.append(e)
+
+    # Keep the drawings ordered on x as well, so each rectangle only has to look at the ones in its horizontal range.
+    by_x = sorted(range(len(xs)), key=xs.__getitem__)
+    xs_sorted = array('d', (xs[i] for i in by_x))
 
     # Iterate over the rectangles in the 'Export' layer
     out_files = []
     for rect in export_layer:
         # Only parse rectangles.
-        tag = rect.tag.replace(f'{{{ns["svg"]}}}', '')
-        if tag != 'rect':
+        if rect.tag != SVG_RECT:
             continue
 
-        # Load the template svg to which the export image is added.
-        outtree = ET.parse("template.svg")
-        out_svg = outtree.getroot()
-
-        # Copy the defs from the original file.
-        defs = root.findall('{http://www.w3.org/2000/svg}defs')
-        for definition in defs:
-            out_svg.append(definition)
+        out_filename = rect.attrib.get('id')
+        if out_filename is None:
+            continue
 
         x_min = float(rect.attrib.get('x'))
         y_min = float(rect.attrib.get('y'))
         x_max = float(rect.attrib.get('width')) + x_min
         y_max = float(rect.attrib.get('height')) + y_min
 
+        lo = bisect.bisect_left(xs_sorted, x_min)
+        hi = bisect.bisect_right(xs_sorted, x_max)
+        # Keep the document order so the stacking of the drawings is preserved.
+        inside = [elements[i] for i in sorted(i for i in by_x[lo:hi] if y_min <= ys[i] <= y_max)]
+
+        # Nothing to export for a rectangle without drawings in it.
+        if not inside:
+            continue
+
         # Set the canvas size and viewport to match the exported image.
         x_view = abs(x_max - x_min)
         y_view = abs(y_max - y_min)
-        out_svg.set('viewBox', f"{x_min} {y_min} {x_view} {y_view}")
-        out_svg.set('width', str(x_view))
-        out_svg.set('height', str(y_view))
+        attrib = dict(template_root.attrib)
+        attrib['viewBox'] = f"{x_min} {y_min} {x_view} {y_view}"
+        attrib['width'] = str(x_view)
+        attrib['height'] = str(y_view)
 
-        out_filename = rect.attrib.get('id')
-        if out_filename is None:
-            continue
-
-        for e in drawing_layer:
-            # Get rid of the namespace from the tag.
-            tag = e.tag.replace(f'{{{ns["svg"]}}}', '')
-
-            sube = e
-            # Does a group transformation apply?
-            gtransform = None
-            # If we have a group get the first element in the group and all the transformations that apply.
-            if tag == 'g':
-                sube, gtransform = get_first_ungrouped_element(e)
-                # # A group has transformations applied which we apply to the reference window.
-                # gtransform = e.attrib.get('transform')
-
-                # # Now get the elements out of the group so we can iterate over them.
-                # elements = []
-                # for sube in e:
-                #     elements.append(sube)
-
-            xy = get_coordinates(sube)
-            if xy is None:
-                continue
-            else:
-                x, y = xy
-
-            if gtransform is not None:
-                for transform in gtransform:
-                    x, y = transform_coordinates(x, y, transform)
-
-            if x and y:
-                if x_min <= x <= x_max and y_min <= y <= y_max:
-                    out_svg.append(e)
-
-        # Write the new SVG to a file
-        tree = ET.ElementTree(out_svg)
-        tree.write(f'{out_filename}.svg')
+        # Write the new SVG to a file, the defs are copied from the original file.
+        write_svg(f'{out_filename}.svg', template_root, attrib, [*defs, *inside])
         out_files.append(out_filename)
 
     return out_files
 
 
+def export_svgs(svg_files: list[str], out_file_type: str):
+    """Export the svgs written by parse_and_export to the given file type with Inkscape and remove the svgs.
+
+    All files are exported by a single Inkscape process in shell mode, so its startup is only paid once. When exporting
+    to svg the written svgs are the output files themselves, so they are kept.
+    """
+    to_svg = out_file_type == 'svg'
+    out_paths = [f"{f}.{out_file_type}" for f in svg_files]
+
+    # Remove the outputs of an earlier run, so a file that is missing afterwards means that its export failed.
+    if not to_svg:
+        for path in out_paths:
+            if os.path.exists(path):
+                os.remove(path)
+
+    actions = ''.join(f'file-open:{f}.svg;export-type:{out_file_type};export-do;file-close\n' for f in svg_files)
+    try:
+        result = subprocess.run(["inkscape", "--shell"], input=actions, text=True, capture_output=True, check=True)
+    except subprocess.CalledProcessError as e:
+        raise RuntimeError(f"Failed to export svg: {e.stderr}") from e
+
+    # The shell logs a failed action and carries on, so only the exported files tell whether it worked. The svgs are
+    # kept when one is missing so nothing is lost.
+    missing = [f for f, path in zip(svg_files, out_paths) if not os.path.exists(path)]
+    if missing:
+        raise RuntimeError(f"Failed to export svg {', '.join(missing)}: {result.stderr}")
+
+    # Treat the svgs as temporary and remove them afterwards.
+    if not to_svg:
+        for f in svg_files:
+            os.remove(f"{f}.svg")
+
+
 if __name__ == '__main__':
     # Add CLI argument parsing.
     parser = argparse.ArgumentParser(description="Export SVG drawings on the Export layer to individual files.")
@@ -250,11 +414,5 @@ if __name__ == '__main__':
     # Process the SVG file.
     exported_files = parse_and_export(svg_file)
 
-    for svg_file in exported_files:
-        result = subprocess.run(
-            ["inkscape", f"--export-type={out_file_type}", f"{svg_file}.svg"], shell=True, capture_output=True)
-        if result.returncode != 0:
-            raise RuntimeError(f"Failed to export svg: {result.stderr}")
-
-        # Treat the svgs as temporary and remove them afterwards.
-        os.remove(f"{svg_file}.svg")
+    if exported_files:
+        export_svgs(exported_files, out_file_type)